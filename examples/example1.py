@@ -1,10 +1,22 @@
-from fsspec.implementations.reference import ReferenceFileSystem
+from typing import List, Tuple
+import os
+import bisect
+import sys
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+import requests
+import fsspec
+from fsspec.implementations.reference import ReferenceFileSystem, LazyReferenceMapper
 import zarr
 from hdmf_zarr.nwb import NWBZarrIO
 import pynwb
 import remfile
 import h5py
 
+# the json helpers are shared with the workflow scripts
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow_scripts'))
+from _common import _json_loads, _json_dumps  # noqa: E402
+
 ####################################################################################################
 # EXAMPLE
 # 000409
@@ -25,28 +37,245 @@ json_url = 'https://lindi.neurosift.org/dandi/dandisets/000717/assets/3d12a902-1
 # h5_url = 'https://api.dandiarchive.org/api/assets/54b277ce-2da7-4730-b86b-cfc8dbf9c6fd/download/'
 # json_url = 'https://lindi.neurosift.org/dandi/dandisets/000409/assets/54b277ce-2da7-4730-b86b-cfc8dbf9c6fd/zarr.json'
 
+reference_cache_dir = os.path.expanduser('~/.cache/neurosift')
+
+# one session, so that the range requests reuse keep-alive connections
+_session = requests.Session()
+
+
+def load_with_kerchunk(block_size: int = 8 * 1024 * 1024):
+    fs = ReferenceFileSystem(
+        fo=_load_reference_json(json_url),
+        fs={'https': _block_cached_https_fs(block_size)}
+    )
+    _read_nwb_from_reference_fs(fs)
+
+
+def load_with_kerchunk_parquet(block_size: int = 8 * 1024 * 1024):
+    # Only the row groups covering the chunk keys that are touched get
+    # loaded, so open time no longer scales with the size of the references
+    parquet_dir = _reference_cache_path(json_url, '.parq')
+    if not os.path.exists(parquet_dir):
+        json_to_parquet(json_url, parquet_dir)
+    mapper = LazyReferenceMapper(root=parquet_dir, fs=fsspec.filesystem('file'))
+    fs = ReferenceFileSystem(fo=mapper, fs={'https': _block_cached_https_fs(block_size)})
+    _read_nwb_from_reference_fs(fs)
+
+
+def json_to_parquet(json_url: str, out_dir: str, record_size: int = 100_000):
+    from kerchunk.df import refs_to_dataframe
+    refs = _load_reference_json(json_url)
+    # lindi stores the zarr metadata inline as objects whereas kerchunk
+    # expects them to be encoded json strings
+    refs = {
+        **refs,
+        'refs': {
+            k: _json_dumps(v).decode() if isinstance(v, dict) else v
+            for k, v in refs['refs'].items()
+        }
+    }
+    refs_to_dataframe(refs, out_dir, record_size=record_size)
+
 
-def load_with_kerchunk():
-    fs = ReferenceFileSystem(json_url)
+def _block_cached_https_fs(block_size: int):
+    # Without this every zarr chunk is its own range GET. Going through a
+    # block cache, one request serves all the small chunks that share a
+    # block, and the blocks persist on disk (mmap-backed) across runs.
+    return fsspec.filesystem(
+        'blockcache',
+        target_protocol='https',
+        target_options={'block_size': block_size},
+        cache_storage=os.path.join(reference_cache_dir, 'blocks'),
+        check_files=False
+    )
+
+
+def _read_nwb_from_reference_fs(fs: ReferenceFileSystem):
     store = fs.get_mapper(root='/', check=False)
-    root = zarr.open(store, mode='r')
+    if isinstance(fs.references, LazyReferenceMapper):
+        # The parquet references keep all the .zgroup/.zarray/.zattrs inline
+        # (mapper.zmetadata), so metadata lookups are already dict lookups.
+        # Consolidating here would instead walk every key and load every
+        # record, which is what the parquet layout is meant to avoid.
+        root = zarr.open_group(store, mode='r')
+    else:
+        # Read all the .zgroup/.zarray/.zattrs in one go from .zmetadata
+        # instead of one lookup per node. The references are held in memory,
+        # so if they don't ship a .zmetadata it can be built once here without
+        # any writes leaving the process.
+        if '.zmetadata' not in store:
+            zarr.consolidate_metadata(store)
+        root = zarr.open_consolidated(store, mode='r')
 
     # Load NWB file
     with NWBZarrIO(path=root, mode="r", load_namespaces=True) as io:
         nwbfile = io.read()
-        print(nwbfile)
-        print('********************************')
-        print(nwbfile.acquisition)
+        _report_nwbfile(nwbfile)
+
+
+def _load_reference_json(url: str) -> dict:
+    # the reference files can be many MB, so keep a copy on disk and parse
+    # with _json_loads (orjson when it can) rather than having fsspec fetch and json.load them each time
+    path = _reference_cache_path(url, '.json')
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            return _json_loads(f.read())
+    r = _session.get(url, timeout=60)
+    r.raise_for_status()
+    # parsed before it is cached, so that a bad download isn't kept
+    refs = _json_loads(r.content)
+    os.makedirs(reference_cache_dir, exist_ok=True)
+    tmp_path = f'{path}.{os.getpid()}.tmp'
+    with open(tmp_path, 'wb') as f:
+        f.write(r.content)
+    os.replace(tmp_path, path)
+    return refs
 
 
-def load_with_h5_streaming():
-    remf = remfile.File(h5_url)
-    h5f = h5py.File(remf, mode='r')
+def _reference_cache_path(url: str, ext: str) -> str:
+    key = hashlib.blake2b(url.encode(), digest_size=16).hexdigest()
+    return os.path.join(reference_cache_dir, f'{key}{ext}')
+
+
+def load_with_h5_streaming(block_size: int = 8 * 1024 * 1024):
+    # h5py issues many tiny reads while walking the superblock and b-trees;
+    # loading in large blocks lets a single request serve hundreds of them
+    remf = remfile.File(h5_url, verbose=False, _min_chunk_size=block_size)
+    f = CoalescingRemoteFile(remf, h5_url)
+    h5f = h5py.File(f, mode='r')
+    prefetch_small_datasets(f, h5f)
     with pynwb.NWBHDF5IO(file=h5f, mode='r', load_namespaces=True) as io:
         nwbfile = io.read()
-        print(nwbfile)
-        print('********************************')
-        print(nwbfile.acquisition)
+        _report_nwbfile(nwbfile)
+
+
+def _report_nwbfile(nwbfile: pynwb.NWBFile):
+    # printing the NWBFile walks the whole tree, which costs a metadata
+    # round-trip per group/dataset, so only do it when asked to
+    if not os.environ.get('NEUROSIFT_VERBOSE'):
+        print(f'Loaded NWB file {nwbfile.identifier}')
+        return
+    print(nwbfile, flush=True)
+    print('********************************', flush=True)
+    print(nwbfile.acquisition, flush=True)
+
+
+class CoalescingRemoteFile:
+    """File-like wrapper around a remfile.File that serves reads from byte
+    ranges prefetched concurrently, falling back to the wrapped file for
+    everything else."""
+
+    def __init__(self, remf, url: str, *, max_workers: int = 16, max_gap: int = 64 * 1024):
+        self._remf = remf
+        self._url = url
+        self._max_workers = max_workers
+        self._max_gap = max_gap
+        self._resolved_url = None
+        self._block_starts: List[int] = []
+        self._blocks: List[bytes] = []
+        self._position = 0
+
+    def prefetch(self, ranges: List[Tuple[int, int]]):
+        # merge contiguous or near-contiguous (offset, size) ranges so that
+        # each group is a single range request, then fire the groups in parallel
+        merged: List[Tuple[int, int]] = []
+        for offset, size in sorted(r for r in ranges if r[1] > 0):
+            if merged and offset - (merged[-1][0] + merged[-1][1]) <= self._max_gap:
+                start = merged[-1][0]
+                merged[-1] = (start, max(merged[-1][1], offset + size - start))
+            else:
+                merged.append((offset, size))
+        if not merged:
+            return
+        if self._resolved_url is None:
+            # the DANDI download url redirects to S3; follow that once rather
+            # than for every range
+            r = _session.head(self._url, allow_redirects=True, timeout=60)
+            r.raise_for_status()
+            self._resolved_url = r.url
+        with ThreadPoolExecutor(max_workers=self._max_workers) as executor:
+            blocks = list(executor.map(lambda r: self._fetch_range(*r), merged))
+        for (offset, _), data in zip(merged, blocks):
+            i = bisect.bisect_left(self._block_starts, offset)
+            self._block_starts.insert(i, offset)
+            self._blocks.insert(i, data)
+
+    def _fetch_range(self, offset: int, size: int) -> bytes:
+        headers = {"Range": f"bytes={offset}-{offset + size - 1}"}
+        r = _session.get(self._resolved_url, headers=headers, timeout=60)
+        r.raise_for_status()
+        return r.content
+
+    def read(self, size=-1):
+        if size is not None and size >= 0:
+            i = bisect.bisect_right(self._block_starts, self._position) - 1
+            if i >= 0:
+                start = self._block_starts[i]
+                block = self._blocks[i]
+                if self._position + size <= start + len(block):
+                    data = block[self._position - start:self._position - start + size]
+                    self._position += size
+                    return data
+        self._remf.seek(self._position)
+        data = self._remf.read(size)
+        self._position += len(data)
+        return data
+
+    def seek(self, offset: int, whence: int = 0):
+        if whence == 0:
+            self._position = offset
+        elif whence == 1:
+            self._position += offset
+        elif whence == 2:
+            self._remf.seek(offset, 2)
+            self._position = self._remf.tell()
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        return self._position
+
+    def tell(self):
+        return self._position
+
+    def close(self):
+        self._remf.close()
+
+
+def prefetch_small_datasets(f: CoalescingRemoteFile, h5f: h5py.File, max_size: int = 64 * 1024):
+    # pynwb reads the small datasets (scalars, strings, short tables) while it
+    # builds the NWBFile, each one a separate round trip; fetched up front,
+    # the ones close together in the file share a single range request
+    ranges: List[Tuple[int, int]] = []
+
+    def visit(name, obj):
+        if isinstance(obj, h5py.Dataset) and obj.id.get_storage_size() <= max_size:
+            ranges.extend(_get_dataset_byte_ranges(obj))
+    h5f.visititems(visit)
+    f.prefetch(ranges)
+
+
+def _get_dataset_byte_ranges(dataset: h5py.Dataset) -> List[Tuple[int, int]]:
+    if dataset.chunks is not None:
+        return _get_chunk_byte_ranges(dataset.id)
+    offset = dataset.id.get_offset()
+    if offset is None:
+        # not allocated yet (reads return the fill value) or compact, i.e.
+        # stored in the object header, which is metadata
+        return []
+    return [(offset, dataset.id.get_storage_size())]
+
+
+def _get_chunk_byte_ranges(dsid: h5py.h5d.DatasetID) -> List[Tuple[int, int]]:
+    ranges: List[Tuple[int, int]] = []
+    if hasattr(dsid, "chunk_iter") and h5py.version.hdf5_version_tuple >= (1, 12, 3):
+        # chunk_iter visits the chunk index in a single pass, whereas
+        # get_chunk_info(i) walks it again for every i, which is unusable
+        # for datasets with ~1M chunks
+        dsid.chunk_iter(lambda info: ranges.append((info.byte_offset, info.size)))
+    else:
+        for i in range(dsid.get_num_chunks()):
+            info = dsid.get_chunk_info(i)
+            ranges.append((info.byte_offset, info.size))
+    return ranges
 
 
 if __name__ == "__main__":
@@ -0,0 +1,48 @@
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow_scripts'))
+
+from _console import _console_print, write_console_output  # noqa: E402
+
+
+def test_other_threads_are_not_captured():
+    # a worker thread keeps logging (as the uploads do) while another thread's
+    # conversion output is being captured
+    started = threading.Event()
+    done = threading.Event()
+
+    def log_from_other_thread():
+        started.set()
+        while not done.is_set():
+            _console_print('uploading from the other thread')
+            time.sleep(0.001)
+
+    thread = threading.Thread(target=log_from_other_thread)
+    thread.start()
+    started.wait()
+    try:
+        with write_console_output() as captured:
+            for i in range(50):
+                # written to the file descriptors directly, like the HDF5 C
+                # library does (pytest replaces sys.stdout itself)
+                os.write(1, f'conversion line {i}\n'.encode())
+                os.write(2, b'hdf5 diagnostic\n')
+                time.sleep(0.001)
+    finally:
+        done.set()
+        thread.join()
+
+    assert 'conversion line 0' in captured.output
+    assert 'conversion line 49' in captured.output
+    assert 'hdf5 diagnostic' in captured.output
+    assert 'uploading from the other thread' not in captured.output
+
+
+def test_large_output_does_not_block():
+    # more than a pipe buffer's worth, written before anything reads it back
+    with write_console_output() as captured:
+        os.write(1, b'x' * (1024 * 1024))
+    assert len(captured.output) == 1024 * 1024
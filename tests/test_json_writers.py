@@ -0,0 +1,79 @@
+import gzip
+import math
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow_scripts'))
+
+import create_dandiset_nwb_meta_files  # noqa: E402
+import create_meta_doc  # noqa: E402
+from _common import LINDI_GENERATION_VERSION, _json_dumps, _json_loads  # noqa: E402
+
+DANDISET_ID = '000001'
+ASSET_ID = 'asset-1'
+FILE_KEY = f'dandi/dandisets/{DANDISET_ID}/assets/{ASSET_ID}/nwb.lindi.json'
+
+
+def _lindi_json():
+    return {
+        'generationMetadata': {'generatedByVersion': LINDI_GENERATION_VERSION},
+        'refs': {
+            'acquisition/ts/data/.zarray': {'fill_value': float('nan'), 'shape': [3]},
+            'acquisition/ts/data/.zattrs': {'conversion': float('inf')},
+            'acquisition/ts/data/0': ['https://example.org/file.nwb', 0, 10]
+        }
+    }
+
+
+class _Asset:
+    identifier = ASSET_ID
+    path = 'sub-1/sub-1.nwb'
+
+
+class _Dandiset:
+    def get_assets_by_glob(self, pattern, order):
+        return [_Asset()]
+
+
+class _Client:
+    def get_dandiset(self, dandiset_id, version):
+        return _Dandiset()
+
+
+def _check_refs(refs):
+    assert math.isnan(refs['acquisition/ts/data/.zarray']['fill_value'])
+    assert refs['acquisition/ts/data/.zattrs']['conversion'] == float('inf')
+
+
+@pytest.mark.parametrize('kwargs', [{}, {'sort_keys': True}, {'indent': True}])
+def test_json_dumps_keeps_non_finite_floats(kwargs):
+    # typical options of the writers: the neurodata types results (plain) and
+    # records (sort_keys), nwb_meta (sort_keys), the meta doc (indent)
+    _check_refs(_json_loads(_json_dumps(_lindi_json(), **kwargs))['refs'])
+
+
+def test_nwb_meta_keeps_nan_fill_value(monkeypatch):
+    uploads = {}
+    monkeypatch.setattr(create_dandiset_nwb_meta_files, '_download_json_gz', lambda url, missing_ok: None)
+    monkeypatch.setattr(create_dandiset_nwb_meta_files, '_list_existing_keys', lambda s3, dandiset_id: {FILE_KEY})
+    monkeypatch.setattr(create_dandiset_nwb_meta_files, '_download_json', lambda url, **kwargs: _lindi_json())
+    monkeypatch.setattr(
+        create_dandiset_nwb_meta_files, '_upload_bytes_to_s3',
+        lambda s3, bucket, key, data, content_type: uploads.__setitem__(key, data)
+    )
+    create_dandiset_nwb_meta_files.handle_dandiset(_Client(), None, DANDISET_ID, 'draft')
+    nwb_meta = _json_loads(gzip.decompress(uploads[f'dandi/nwb_meta/{DANDISET_ID}.json.gz']))
+    _check_refs(nwb_meta['files'][0]['nwb_meta']['refs'])
+
+
+def test_meta_doc_keeps_nan_fill_value(monkeypatch, tmp_path):
+    # handle_dandiset writes its results under the working directory
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(create_meta_doc, '_list_existing_keys', lambda s3, dandiset_id: {FILE_KEY})
+    monkeypatch.setattr(create_meta_doc, '_download_json', lambda url, **kwargs: _lindi_json())
+    create_meta_doc.handle_dandiset(_Client(), None, DANDISET_ID, 'draft')
+    with open(create_meta_doc._results_fname(DANDISET_ID), 'rb') as f:
+        files = _json_loads(f.read())
+    _check_refs(files[0]['zarr_json_meta']['refs'])
@@ -0,0 +1,80 @@
+import datetime
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow_scripts'))
+
+import create_neurodata_types_index  # noqa: E402
+from _common import LINDI_GENERATION_VERSION  # noqa: E402
+
+DANDISET_ID = '000001'
+
+
+def _file_key(asset_id):
+    return f'dandi/dandisets/{DANDISET_ID}/assets/{asset_id}/nwb.lindi.json'
+
+
+class _Asset:
+    def __init__(self, identifier):
+        self.identifier = identifier
+        self.path = f'{identifier}.nwb'
+
+
+class _Version:
+    def __init__(self, modified, asset_count):
+        self.modified = modified
+        self.asset_count = asset_count
+
+
+class _Dandiset:
+    def __init__(self, version, asset_ids):
+        self.version = version
+        self._asset_ids = asset_ids
+
+    def get_assets_by_glob(self, pattern, order):
+        return [_Asset(asset_id) for asset_id in self._asset_ids]
+
+
+class _Client:
+    def __init__(self, dandiset):
+        self.dandiset = dandiset
+
+    def get_dandiset(self, dandiset_id, version):
+        return self.dandiset
+
+
+def test_results_cache_follows_the_dandiset(monkeypatch, tmp_path):
+    monkeypatch.setattr(create_neurodata_types_index, '_RESULTS_CACHE_DIR', str(tmp_path))
+    existing_keys = {_file_key('a')}
+    monkeypatch.setattr(create_neurodata_types_index, '_list_existing_keys', lambda s3, dandiset_id: set(existing_keys))
+    downloads = []
+
+    def download_json(url, **kwargs):
+        downloads.append(url)
+        return {
+            'generationMetadata': {'generatedByVersion': LINDI_GENERATION_VERSION},
+            'refs': {'.zattrs': {'neurodata_type': 'NWBFile'}}
+        }
+    monkeypatch.setattr(create_neurodata_types_index, '_download_json', download_json)
+
+    modified = datetime.datetime(2026, 1, 1, tzinfo=datetime.timezone.utc)
+    dandiset = _Dandiset(_Version(modified, 2), ['a', 'b'])
+
+    def run():
+        files = create_neurodata_types_index.handle_dandiset(_Client(dandiset), None, DANDISET_ID, 'draft', {})
+        return sorted(file['asset_id'] for file in files)
+
+    assert run() == ['a']
+    assert len(downloads) == 1
+    # nothing changed: the cached results are used
+    assert run() == ['a']
+    assert len(downloads) == 1
+    # a lindi file was generated for another asset
+    existing_keys.add(_file_key('b'))
+    assert run() == ['a', 'b']
+    assert len(downloads) == 3
+    # the draft was modified under the same version name
+    dandiset.version = _Version(modified + datetime.timedelta(days=1), 2)
+    assert run() == ['a', 'b']
+    assert len(downloads) == 5
+    assert [name for name in os.listdir(tmp_path) if name.endswith('.tmp')] == []
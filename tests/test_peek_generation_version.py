@@ -0,0 +1,34 @@
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'workflow_scripts'))
+
+from _common import _json_dumps, _peek_generation_version  # noqa: E402
+
+
+def _chunks(data: bytes, size: int):
+    return (data[i:i + size] for i in range(0, len(data), size))
+
+
+def test_finds_version_after_long_console_output():
+    data = _json_dumps({
+        'generationMetadata': {
+            # sorts before generatedByVersion, and mentions it
+            'console_output': 'x' * 100000 + ' "generatedByVersion": 3 ',
+            'generatedByVersion': 12
+        },
+        'refs': {'.zattrs': {}}
+    }, sort_keys=True)
+    assert data.index(b'"generatedByVersion":12') > 4096
+    for size in [7, 4096, 65536]:
+        chunks = _chunks(data, size)
+        head, version = _peek_generation_version(chunks)
+        assert version == 12
+        # the rest of the body is still there for the caller
+        assert head + b''.join(chunks) == data
+
+
+def test_no_version():
+    data = _json_dumps({'refs': {'.zattrs': {}}})
+    chunks = _chunks(data, 5)
+    assert _peek_generation_version(chunks) == (data, None)
@@ -0,0 +1,508 @@
+from typing import List, Set, Tuple, Union
+import time
+import json
+import os
+import hashlib
+import io
+import threading
+import gzip
+import itertools
+import math
+import random
+import re
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+import boto3
+from botocore.config import Config
+from boto3.s3.transfer import TransferConfig
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+try:
+    import orjson
+except ImportError:
+    orjson = None
+try:
+    import simdjson
+except ImportError:
+    simdjson = None
+
+# Helpers shared by the create_* workflow scripts
+
+# the generatedByVersion that dandi_lindi writes into nwb.lindi.json; the
+# create_* scripts only read lindi files generated by this version
+LINDI_GENERATION_VERSION = 12
+
+# local copies of downloaded json (lindi files, dandiset listing pages), revalidated with If-None-Match
+_HTTP_CACHE_DIR = os.environ.get(
+    "NEUROSIFT_HTTP_CACHE_DIR",
+    os.path.expanduser("~/.cache/neurosift-kerchunker/http")
+)
+# Bodies bigger than this (most nwb.lindi.json files) aren't kept: the create_*
+# scripts keep their results per asset in S3 anyways, so they only download the
+# lindi files of new assets. The directory is pruned to _HTTP_CACHE_MAX_SIZE,
+# least recently used first, when a process first uses it.
+_HTTP_CACHE_MAX_BODY_SIZE = 1024 * 1024
+_HTTP_CACHE_MAX_SIZE = 256 * 1024 * 1024
+_http_cache_pruned = False
+_http_cache_prune_lock = threading.Lock()
+
+
+class _JitteredRetry(Retry):
+    # full jitter on top of the exponential backoff, so that workers throttled at
+    # the same moment don't all retry at the same moment (urllib3 1.26, which
+    # botocore pins on Python 3.8, has no backoff_jitter option)
+    def get_backoff_time(self):
+        return random.uniform(0, super().get_backoff_time())
+
+
+# One session for the whole process, so that requests to the same host reuse
+# keep-alive connections instead of paying for a new TLS handshake each time.
+# Transient failures (including 429, honoring Retry-After) are retried inside the adapter.
+_SESSION = requests.Session()
+_SESSION.headers.update({  # user-agent is required for some servers
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
+})
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32,
+    pool_maxsize=256,  # up to 10 dandisets x 16 assets in flight
+    max_retries=_JitteredRetry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=("GET", "HEAD", "PUT"),
+        respect_retry_after_header=True
+    )
+))
+
+_CONTENT_TYPES = {
+    ".html": "text/html",
+    ".js": "application/javascript",
+    ".css": "text/css",
+    ".png": "image/png",
+    ".jpg": "image/jpeg",
+    ".svg": "image/svg+xml",
+    ".json": "application/json",
+    ".gz": "application/gzip",
+    ".zst": "application/zstd",
+    ".py": "text/x-python",
+}
+
+
+# written by build_lindi_index.py, after each dandi-lindi run: the nwb.lindi.json
+# asset ids for every dandiset. An index that is older than the start of the
+# latest dandi-lindi run (daily, up to 6 hours long) misses the assets that run
+# generated, and those would count as missing, so an index from the previous
+# day's run is not used.
+_LINDI_INDEX_KEY = 'dandi/lindi_index.json.gz'
+_MAX_LINDI_INDEX_AGE_HOURS = 12
+_lindi_index = None
+_lindi_index_loaded = False
+_lindi_index_lock = threading.Lock()
+
+_DANDISETS_PAGE_SIZE = 200
+
+# the dandiset list is reused for a few minutes, so that scripts run back to
+# back (or restarted) don't each page through the whole listing again
+_DANDISETS_CACHE_TTL_SEC = 15 * 60
+
+# uploads below this size go through a single put_object
+_PUT_OBJECT_MAX_SIZE = 5 * 1024 * 1024
+
+# smaller parts and more of them in flight, so that a single big upload
+# isn't limited to the throughput of a few connections
+_TRANSFER_CONFIG = TransferConfig(
+    multipart_threshold=8 * 1024 * 1024,
+    multipart_chunksize=8 * 1024 * 1024,
+    max_concurrency=16,
+    use_threads=True
+)
+
+
+def _json_loads(data: Union[bytes, str]):
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except orjson.JSONDecodeError:
+            pass  # e.g. NaN, which orjson rejects but json accepts
+    return json.loads(data)
+
+
+def _json_dumps(obj, *, sort_keys: bool = False, indent: bool = False) -> bytes:
+    # orjson is several times faster than json, but it writes NaN and Infinity
+    # as null where json keeps them, and lindi attribute values (a .zarray
+    # fill_value, say) can be either, so those (rare) objects go through json,
+    # with the same separators
+    if orjson is not None and not _has_non_finite_float(obj):
+        option = 0
+        if sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if indent:
+            option |= orjson.OPT_INDENT_2
+        try:
+            return orjson.dumps(obj, option=option)
+        except orjson.JSONEncodeError:
+            pass  # e.g. a type orjson doesn't serialize
+    if indent:
+        return json.dumps(obj, sort_keys=sort_keys, indent=2).encode('utf-8')
+    return json.dumps(obj, sort_keys=sort_keys, separators=(',', ':')).encode('utf-8')
+
+
+def _has_non_finite_float(obj) -> bool:
+    stack = [obj]
+    while stack:
+        x = stack.pop()
+        if isinstance(x, float):
+            if not math.isfinite(x):
+                return True
+        elif isinstance(x, dict):
+            stack.extend(x.values())
+        elif isinstance(x, (list, tuple)):
+            stack.extend(x)
+    return False
+
+
+_thread_local = threading.local()
+
+_s3_client = None
+_s3_client_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # A forked worker (dandi_lindi) must not share the parent's S3 client or the
+    # keep-alive sockets in _SESSION's pool; both are rebuilt on first use.
+    # The locks are replaced too, in case another thread held one at fork time.
+    global _s3_client, _s3_client_lock, _lindi_index_lock, _http_cache_prune_lock
+    _s3_client = None
+    _s3_client_lock = threading.Lock()
+    _http_cache_prune_lock = threading.Lock()
+    _lindi_index_lock = threading.Lock()
+    _SESSION.close()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _json_loads_lazy(data: bytes):
+    # With pysimdjson, objects and arrays are proxies that are only decoded
+    # when accessed, which is much cheaper when only a few refs are read.
+    # The result is only valid until the next parse on the same thread, so
+    # callers must convert what they keep (_to_python) before returning.
+    if simdjson is None:
+        return _json_loads(data)
+    parser = getattr(_thread_local, 'simdjson_parser', None)
+    if parser is None:
+        parser = _thread_local.simdjson_parser = simdjson.Parser()
+    try:
+        try:
+            return parser.parse(data)
+        except RuntimeError:
+            # the previous document on this thread is still referenced
+            return simdjson.Parser().parse(data)
+    except ValueError:
+        return _json_loads(data)
+
+
+def _to_python(value):
+    if simdjson is not None:
+        if isinstance(value, simdjson.Object):
+            return value.as_dict()
+        if isinstance(value, simdjson.Array):
+            return value.as_list()
+    return value
+
+
+@dataclass
+class Dandiset:
+    # a plain dataclass rather than a pydantic model: the fields come straight
+    # from the DANDI API, so there's nothing to validate
+    # (slots by hand, since dataclass(slots=True) needs Python 3.10)
+    __slots__ = ("dandiset_id", "version")
+    dandiset_id: str
+    version: str
+
+
+def fetch_all_dandisets():
+    cache_fname = os.path.join(_HTTP_CACHE_DIR, 'dandisets.json')
+    if os.path.exists(cache_fname) and time.time() - os.path.getmtime(cache_fname) < _DANDISETS_CACHE_TTL_SEC:
+        with open(cache_fname, 'rb') as f:
+            return [Dandiset(**ds) for ds in _json_loads(f.read())]
+
+    # paginate rather than trusting one huge page not to be truncated; the
+    # first page gives the count, and the remaining pages are fetched concurrently.
+    # Pages go through _download_json, so once the TTL has expired a page that
+    # hasn't changed since the last run is revalidated with If-None-Match.
+    def fetch_page(page: int) -> dict:
+        url = f"https://api.dandiarchive.org/api/dandisets/?page={page}&page_size={_DANDISETS_PAGE_SIZE}&ordering=-modified&draft=true&empty=false&embargoed=false"
+        return _download_json(url)
+
+    first_page = fetch_page(1)
+    num_pages = max(1, math.ceil(first_page["count"] / _DANDISETS_PAGE_SIZE))
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        pages = [first_page] + list(executor.map(fetch_page, range(2, num_pages + 1)))
+
+    dandisets: List[Dandiset] = [
+        _dandiset_from_api(ds) for X in pages for ds in X["results"]
+    ]
+
+    os.makedirs(_HTTP_CACHE_DIR, exist_ok=True)
+    tmp_fname = f'{cache_fname}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_fname, 'wb') as f:
+        f.write(_json_dumps([{"dandiset_id": ds.dandiset_id, "version": ds.version} for ds in dandisets]))
+    os.replace(tmp_fname, cache_fname)
+    return dandisets
+
+
+def fetch_dandiset(dandiset_id: str) -> Dandiset:
+    # for scripts that only handle a given dandiset: one small request
+    # instead of the whole listing
+    r = _SESSION.get(f"https://api.dandiarchive.org/api/dandisets/{dandiset_id}/", timeout=60)
+    r.raise_for_status()
+    return _dandiset_from_api(_json_loads(r.content))
+
+
+def _dandiset_from_api(ds: dict) -> Dandiset:
+    pv = ds["most_recent_published_version"]
+    dv = ds["draft_version"]
+    return Dandiset(
+        dandiset_id=ds["identifier"],
+        version=pv["version"] if pv else dv["version"],
+    )
+
+
+def _get_s3_client():
+    # one client per process: boto3 clients are thread-safe, and building one
+    # means loading service models and doing a fresh TLS handshake
+    global _s3_client
+    with _s3_client_lock:
+        if _s3_client is None:
+            _s3_client = boto3.client(
+                "s3",
+                aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
+                aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
+                endpoint_url=os.environ["S3_ENDPOINT_URL"],
+                region_name="auto",  # for cloudflare
+                config=Config(
+                    # exponential backoff with jitter plus a client-side rate limiter,
+                    # so that a burst of 503 Slow Down doesn't turn into a retry storm
+                    retries={"max_attempts": 10, "mode": "adaptive"},
+                    max_pool_connections=64  # room for concurrent multipart upload parts
+                )
+            )
+        return _s3_client
+
+
+def _map_in_batches(executor, fn, iterable, batch_size: int):
+    # like executor.map, but only pulls batch_size items at a time from the
+    # iterable, and yields (item, result) pairs in order
+    iterator = iter(iterable)
+    while True:
+        batch = list(itertools.islice(iterator, batch_size))
+        if not batch:
+            return
+        yield from zip(batch, executor.map(fn, batch))
+
+
+def _get_lindi_index() -> Union[dict, None]:
+    # loaded once per process; None if it is missing or too old to trust
+    global _lindi_index, _lindi_index_loaded
+    with _lindi_index_lock:
+        if not _lindi_index_loaded:
+            _lindi_index_loaded = True
+            try:
+                index = _download_json_gz(f'https://lindi.neurosift.org/{_LINDI_INDEX_KEY}', missing_ok=True)
+            except Exception as e:
+                print(f"Error downloading lindi index: {e}")
+                index = None
+            if index is None:
+                print("No lindi index, listing each dandiset instead")
+            elif time.time() - index['generatedAt'] > _MAX_LINDI_INDEX_AGE_HOURS * 60 * 60:
+                print("Lindi index is out of date, listing each dandiset instead")
+                index = None
+            _lindi_index = index
+        return _lindi_index
+
+
+def _list_existing_keys(s3, dandiset_id: str) -> Set[str]:
+    index = _get_lindi_index()
+    if index is not None:
+        return {
+            f'dandi/dandisets/{dandiset_id}/assets/{asset_id}/nwb.lindi.json'
+            for asset_id in index['dandisets'].get(dandiset_id, [])
+        }
+    # a single paginated listing (1000 keys per page) replaces a request per asset
+    paginator = s3.get_paginator('list_objects_v2')
+    return {
+        obj['Key']
+        for page in paginator.paginate(Bucket='neurosift-lindi', Prefix=f'dandi/dandisets/{dandiset_id}/assets/')
+        for obj in page.get('Contents', [])
+    }
+
+
+def _get_neurodata_types_for_zarr_json(zarr_json: dict) -> List[str]:
+    neurodata_types = set()
+    refs = zarr_json.get("refs", {})
+    # keys rather than items(): with a lazy document, items() would decode every ref
+    for key in refs:
+        if key[-7:] == '.zattrs':
+            zattrs = refs[key]
+            # a dict (or lazy object) in lindi files; a JSON string in plain kerchunk refs
+            ndt = zattrs.get("neurodata_type") if hasattr(zattrs, "get") else None
+            if ndt:
+                neurodata_types.add(ndt)
+    return sorted(neurodata_types)
+
+
+def _upload_file_to_s3(s3, bucket, object_key, fname):
+    content_type = _CONTENT_TYPES.get(os.path.splitext(fname)[1].lower())
+    extra_args = {}
+    if content_type is not None:
+        extra_args["ContentType"] = content_type
+    # small files skip the transfer manager (and its thread pool) entirely
+    size = os.path.getsize(fname)
+    if size < _PUT_OBJECT_MAX_SIZE:
+        with open(fname, "rb") as f:
+            s3.put_object(Bucket=bucket, Key=object_key, Body=f.read(), **extra_args)
+    else:
+        s3.upload_file(fname, bucket, object_key, ExtraArgs=extra_args, Config=_TRANSFER_CONFIG)
+
+
+def _upload_bytes_to_s3(
+    s3,
+    bucket,
+    object_key,
+    data: bytes,
+    *,
+    content_type: str,
+    metadata: Union[dict, None] = None
+):
+    # metadata: user metadata (x-amz-meta-*), returned by head_object
+    extra_args = {"ContentType": content_type}
+    if metadata is not None:
+        extra_args["Metadata"] = metadata
+    if len(data) < _PUT_OBJECT_MAX_SIZE:
+        s3.put_object(Bucket=bucket, Key=object_key, Body=data, **extra_args)
+    else:
+        # large objects go up in parallel parts, straight from memory
+        s3.upload_fileobj(
+            io.BytesIO(data), bucket, object_key,
+            ExtraArgs=extra_args,
+            Config=_TRANSFER_CONFIG
+        )
+
+
+def _download_json(
+    url: str,
+    *,
+    missing_ok: bool = False,
+    lazy: bool = False,
+    generation_version: Union[int, None] = None
+):
+    # with missing_ok, a 404 returns None, which saves a HEAD request beforehand.
+    # The last response is kept on disk with its ETag, so an unchanged file only
+    # costs a 304 on the next run rather than the whole body.
+    # With lazy, see _json_loads_lazy.
+    # With generation_version, a lindi file generated by a different version
+    # returns None without reading the refs (see _peek_generation_version).
+    loads = _json_loads_lazy if lazy else _json_loads
+    _prune_http_cache_once()
+    cache_fname = os.path.join(_HTTP_CACHE_DIR, hashlib.sha1(url.encode('utf-8')).hexdigest())
+    headers = {}
+    if os.path.exists(cache_fname + '.json') and os.path.exists(cache_fname + '.etag'):
+        with open(cache_fname + '.etag', 'r') as f:
+            headers['If-None-Match'] = f.read()
+    with _SESSION.get(url, headers=headers, timeout=30, stream=True) as r:
+        if r.status_code == 304:
+            # a use, as far as pruning is concerned
+            os.utime(cache_fname + '.json')
+            with open(cache_fname + '.json', 'rb') as f:
+                return loads(f.read())
+        if r.status_code == 404 and missing_ok:
+            return None
+        r.raise_for_status()
+        if generation_version is not None:
+            chunks = r.iter_content(_PEEK_CHUNK_SIZE)
+            head, version = _peek_generation_version(chunks)
+            if version not in (None, generation_version):
+                # closing the response drops the connection before the rest is sent
+                return None
+            content = head + b''.join(chunks)
+        else:
+            content = r.content
+        etag = r.headers.get('ETag')
+    if etag and len(content) <= _HTTP_CACHE_MAX_BODY_SIZE:
+        os.makedirs(_HTTP_CACHE_DIR, exist_ok=True)
+        # write the body before the etag so an interrupted write never pairs a new etag with an old body
+        for ext, data in [('.json', content), ('.etag', etag.encode('utf-8'))]:
+            tmp_fname = f'{cache_fname}{ext}.{os.getpid()}.{threading.get_ident()}.tmp'
+            with open(tmp_fname, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_fname, cache_fname + ext)
+    return loads(content)
+
+
+def _prune_http_cache_once():
+    global _http_cache_pruned
+    with _http_cache_prune_lock:
+        if not _http_cache_pruned:
+            _http_cache_pruned = True
+            _prune_http_cache()
+
+
+def _prune_http_cache():
+    # An entry is all the files with the same name before the first dot: the
+    # body, its etag and any leftover temporary files. Oldest first by the latest
+    # mtime of its files; a 304 refreshes the mtime of the body.
+    entries = {}
+    try:
+        with os.scandir(_HTTP_CACHE_DIR) as it:
+            for e in it:
+                if not e.is_file():
+                    continue
+                key = e.name.split('.', 1)[0]
+                st = e.stat()
+                mtime, size, paths = entries.get(key, (0, 0, []))
+                entries[key] = (max(mtime, st.st_mtime), size + st.st_size, paths + [e.path])
+    except FileNotFoundError:
+        return
+    total_size = sum(size for _, size, _ in entries.values())
+    for _, size, paths in sorted(entries.values()):
+        if total_size <= _HTTP_CACHE_MAX_SIZE:
+            break
+        # the etag goes first, so a body is never used without it
+        for path in sorted(paths, key=lambda p: not p.endswith('.etag')):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+        total_size -= size
+
+
+# lindi writes its JSON with sorted keys, so generationMetadata comes before
+# refs. It is not necessarily near the start of the file though: console_output
+# sorts before generatedByVersion and can be long, so the body is read until
+# the key shows up. (Inside console_output, a quote is escaped and can't match.)
+_PEEK_CHUNK_SIZE = 64 * 1024
+_GENERATED_BY_VERSION_RE = re.compile(rb'"generatedByVersion"\s*:\s*(\d+)')
+
+
+def _peek_generation_version(chunks) -> Tuple[bytes, Union[int, None]]:
+    # consumes chunks until generatedByVersion is found or they run out; returns
+    # what was read and the version (None if not found)
+    head = bytearray()
+    for chunk in chunks:
+        # a match can straddle two chunks
+        start = max(0, len(head) - 64)
+        head += chunk
+        m = _GENERATED_BY_VERSION_RE.search(head, start)
+        if m:
+            return bytes(head), int(m.group(1))
+    return bytes(head), None
+
+
+def _download_json_gz(url: str, *, missing_ok: bool = False) -> Union[dict, None]:
+    r = _SESSION.get(url, timeout=30)
+    if r.status_code == 404 and missing_ok:
+        return None
+    r.raise_for_status()
+    return _json_loads(gzip.decompress(r.content))
@@ -0,0 +1,69 @@
+import os
+import sys
+import threading
+
+# Console output for the dandi_lindi workers.
+#
+# write_console_output redirects fd 1 and 2 for the whole process while a
+# conversion runs, so anything the other threads of the worker print in the
+# meantime would end up in that conversion's console_output (which is published
+# in nwb.lindi.json and info.json). They print with _console_print instead,
+# which writes to a copy of the original stdout taken at import.
+_console = os.fdopen(os.dup(1), 'w', buffering=1)
+_console_lock = threading.Lock()
+
+
+def _reset_after_fork():
+    # in case another thread held the lock at fork time
+    global _console_lock
+    _console_lock = threading.Lock()
+
+
+os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+def _console_print(*args):
+    with _console_lock:
+        print(*args, file=_console, flush=True)
+
+
+class write_console_output:
+    # fd 1 and 2 point at a pipe while inside, and a reader thread drains it into
+    # memory (so a chatty conversion can't fill the pipe and block); the text is
+    # in .output after exiting
+    def __init__(self):
+        self.output = ''
+
+    def __enter__(self):
+        # anything still buffered by python belongs to the previous output
+        sys.stdout.flush()
+        sys.stderr.flush()
+        read_fd, write_fd = os.pipe()
+        self._chunks = []
+        self._reader = threading.Thread(target=self._drain, args=(read_fd,), daemon=True)
+        self._reader.start()
+        self.stdout = os.dup(1)
+        self.stderr = os.dup(2)
+        os.dup2(write_fd, 1)
+        os.dup2(write_fd, 2)
+        os.close(write_fd)
+        return self
+
+    def __exit__(self, type, value, traceback):
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os.dup2(self.stdout, 1)
+        os.dup2(self.stderr, 2)
+        os.close(self.stdout)
+        os.close(self.stderr)
+        # the last write end of the pipe is gone, so the reader sees EOF
+        self._reader.join()
+        self.output = b''.join(self._chunks).decode('utf-8', errors='replace')
+
+    def _drain(self, read_fd):
+        with os.fdopen(read_fd, 'rb', buffering=0) as f:
+            while True:
+                chunk = f.read(65536)
+                if not chunk:
+                    break
+                self._chunks.append(chunk)
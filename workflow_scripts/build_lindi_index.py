@@ -0,0 +1,56 @@
+import os
+import time
+import gzip
+from _common import (
+    _get_s3_client,
+    _upload_bytes_to_s3,
+    _json_dumps,
+    _LINDI_INDEX_KEY,
+)
+
+
+def main():
+    build_lindi_index()
+
+
+def build_lindi_index():
+    if os.environ.get("AWS_ACCESS_KEY_ID") is None:
+        raise ValueError("AWS_ACCESS_KEY_ID not set.")
+    if os.environ.get("AWS_SECRET_ACCESS_KEY") is None:
+        raise ValueError("AWS_SECRET_ACCESS_KEY not set.")
+    if os.environ.get("S3_ENDPOINT_URL") is None:
+        raise ValueError("S3_ENDPOINT_URL not set.")
+
+    s3 = _get_s3_client()
+
+    # dandi/dandisets/{dandiset_id}/assets/{asset_id}/nwb.lindi.json
+    asset_ids_by_dandiset_id = {}
+    num_keys = 0
+    paginator = s3.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket='neurosift-lindi', Prefix='dandi/dandisets/'):
+        for obj in page.get('Contents', []):
+            num_keys += 1
+            parts = obj['Key'].split('/')
+            if len(parts) != 6 or parts[3] != 'assets' or parts[5] != 'nwb.lindi.json':
+                continue
+            asset_ids_by_dandiset_id.setdefault(parts[2], []).append(parts[4])
+    num_assets = sum(len(v) for v in asset_ids_by_dandiset_id.values())
+    print(f'Listed {num_keys} keys: {num_assets} lindi files in {len(asset_ids_by_dandiset_id)} dandisets')
+
+    index = {
+        'generatedAt': time.time(),
+        'dandisets': asset_ids_by_dandiset_id
+    }
+    data = gzip.compress(_json_dumps(index, sort_keys=True), compresslevel=6)
+    print(f'Uploading {_LINDI_INDEX_KEY}')
+    _upload_bytes_to_s3(
+        s3,
+        'neurosift-lindi',
+        _LINDI_INDEX_KEY,
+        data,
+        content_type='application/gzip'
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,23 @@
-from typing import List
-import time
-import json
+from typing import Set, Union
 import os
-from pydantic import BaseModel
-import urllib.request
-import urllib.error
-import dandi.dandiarchive as da
+from dandi.dandiapi import DandiAPIClient
+from dandi.exceptions import NotFoundError
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from _common import (
+    fetch_all_dandisets,
+    _get_s3_client,
+    _map_in_batches,
+    _list_existing_keys,
+    _download_json,
+    _json_loads,
+    _json_dumps,
+    _to_python,
+    LINDI_GENERATION_VERSION,
+)
+
+num_parallel_assets = 16
+
+_ZARR_JSON_META_REF_SUFFIXES = ('.zattrs', '.zarray')
 
 
 def create_meta_doc():
@@ -19,11 +30,15 @@ def create_meta_doc():
 
     dandisets = fetch_all_dandisets()
 
+    # boto3 clients are thread-safe, so build one and share it with every dandiset
+    s3 = _get_s3_client()
+
     results = []
-    with ThreadPoolExecutor(max_workers=1) as executor:
+    # one client (and its keep-alive session) shared by all dandisets
+    with DandiAPIClient() as client, ThreadPoolExecutor(max_workers=8) as executor:
         futures = {
             executor.submit(
-                handle_dandiset, dandiset.dandiset_id, dandiset.version
+                handle_dandiset, client, s3, dandiset.dandiset_id, dandiset.version
             ):
             dandiset for dandiset in dandisets
         }
@@ -33,73 +48,64 @@ def create_meta_doc():
             print(f"Completed {num_completed}/{len(dandisets)} dandisets")
             result = future.result()
             if result:
-                size_of_result = len(json.dumps(result))
+                # handle_dandiset has just written (or read) this file, so no need to serialize again
+                size_of_result = os.path.getsize(_results_fname(futures[future].dandiset_id))
                 print(f'Size of result (MB): {size_of_result / 1024 / 1024}')
                 results.extend(result)
 
 
+def _results_fname(dandiset_id: str) -> str:
+    return f'results/{dandiset_id}.json'
+
+
 def handle_dandiset(
+    client: DandiAPIClient,
+    s3,
     dandiset_id: str,
     dandiset_version: str
 ):
     print(f"Processing dandiset {dandiset_id} version {dandiset_version}")
 
-    fname = f'results/{dandiset_id}.json'
+    fname = _results_fname(dandiset_id)
     if os.path.exists(fname):
-        with open(fname, 'r') as f:
-            return json.load(f)
-
-    # Create the dandi parsed url
-    parsed_url = da.parse_dandi_url(f"https://dandiarchive.org/dandiset/{dandiset_id}")
-
-    with parsed_url.navigate() as (client, dandiset, assets):
-        if dandiset is None:
-            print(f"Dandiset {dandiset_id} not found.")
-            return
-
-        files = []
-
-        num_consecutive_not_nwb = 0
-        num_consecutive_not_found = 0
-        # important to respect the iterator so we don't pull down all the assets at once
-        # and overwhelm the server
-        num_assets_processed = 0
-        for asset_obj in dandiset.get_assets('path'):
-            if not asset_obj.path.endswith(".nwb"):
-                num_consecutive_not_nwb += 1
-                if num_consecutive_not_nwb >= 20:
-                    # For example, this is important for 000026 because there are so many non-nwb assets
-                    print("Stopping dandiset because too many consecutive non-NWB files.")
-                    break
-                continue
-            else:
-                num_consecutive_not_nwb = 0
+        with open(fname, 'rb') as f:
+            return _json_loads(f.read())
+
+    existing_keys = _list_existing_keys(s3, dandiset_id)
+
+    try:
+        dandiset = client.get_dandiset(dandiset_id, dandiset_version)
+    except NotFoundError:
+        print(f"Dandiset {dandiset_id} not found.")
+        return
+
+    files = []
+
+    num_consecutive_not_found = 0
+    # important to respect the iterator so we don't pull down all the assets at once
+    # and overwhelm the server. The lindi files for each batch of assets are fetched
+    # concurrently (that's a different server).
+    num_assets_processed = 0
+    with ThreadPoolExecutor(max_workers=num_parallel_assets) as asset_executor:
+        for asset_obj, zarr_json_meta in _map_in_batches(
+            asset_executor,
+            lambda asset_obj: _get_zarr_json_meta_for_asset(dandiset_id, asset_obj.identifier, existing_keys),
+            dandiset.get_assets_by_glob('*.nwb', 'path'),
+            batch_size=num_parallel_assets
+        ):
             if num_consecutive_not_found >= 20:
                 print("Stopping dandiset because too many consecutive missing files.")
                 break
             if num_assets_processed >= 100:
                 print("Stopping dandiset because 100 assets have been processed.")
                 break
+            if zarr_json_meta is None:
+                num_consecutive_not_found += 1
+                continue
             asset_id = asset_obj.identifier
             asset_path = asset_obj.path
             file_key = f'dandi/dandisets/{dandiset_id}/assets/{asset_id}/nwb.lindi.json'
             zarr_json_url = f'https://lindi.neurosift.org/{file_key}'
-            if not _remote_file_exists(zarr_json_url):
-                num_consecutive_not_found += 1
-                continue
-            print(f'Downloading {zarr_json_url}')
-            zarr_json = _download_json(zarr_json_url)
-            generation_metadata = zarr_json.get("generationMetadata", {})
-            generation_version = generation_metadata.get("generatedByVersion")
-            if generation_version != 9:
-                num_consecutive_not_found += 1
-                continue
-            zarr_json_meta = {
-                'refs': {}
-            }
-            for k in zarr_json['refs'].keys():
-                if k.endswith('.zattrs') or k.endswith('.zarray'):
-                    zarr_json_meta['refs'][k] = zarr_json['refs'][k]
             file = {
                 'dandiset_id': dandiset_id,
                 'dandiset_version': dandiset_version,
@@ -110,115 +116,37 @@ def handle_dandiset(
             }
             files.append(file)
             num_assets_processed += 1
-        # make sure parent directory of fname exists
-        os.makedirs(os.path.dirname(fname), exist_ok=True)
-        with open(fname, 'w') as f:
-            json.dump(files, f, indent=2)
-        return files
-
-
-def _get_neurodata_types_for_zarr_json(zarr_json: dict) -> List[str]:
-    neurodata_types = set()
-    refs = zarr_json.get("refs", {})
-    for key in refs:
-        if key.endswith('.zattrs'):
-            zattrs = refs[key]
-            ndt = zattrs.get("neurodata_type")
-            if ndt:
-                neurodata_types.add(ndt)
-    return sorted(neurodata_types)
-
-
-def _remote_file_exists(url: str) -> bool:
-    # use a HEAD request to check if the file exists
-    headers = {  # user-agent is required for some servers
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
+    # make sure parent directory of fname exists
+    os.makedirs(os.path.dirname(fname), exist_ok=True)
+    with open(fname, 'wb') as f:
+        f.write(_json_dumps(files, indent=True))
+    return files
+
+
+def _get_zarr_json_meta_for_asset(dandiset_id: str, asset_id: str, existing_keys: Set[str]) -> Union[dict, None]:
+    file_key = f'dandi/dandisets/{dandiset_id}/assets/{asset_id}/nwb.lindi.json'
+    zarr_json_url = f'https://lindi.neurosift.org/{file_key}'
+    if file_key not in existing_keys:
+        return None
+    print(f'Downloading {zarr_json_url}')
+    zarr_json = _download_json(zarr_json_url, lazy=True, generation_version=LINDI_GENERATION_VERSION)
+    if zarr_json is None:
+        return None
+    generation_metadata = zarr_json.get("generationMetadata", {})
+    generation_version = generation_metadata.get("generatedByVersion")
+    if generation_version != LINDI_GENERATION_VERSION:
+        return None
+    # iterate the keys and index only the matches, so that with a lazy document
+    # the chunk refs are never decoded
+    refs = zarr_json['refs']
+    zarr_json_meta = {
+        'refs': {
+            k: _to_python(refs[k])
+            for k in refs
+            if k.endswith(_ZARR_JSON_META_REF_SUFFIXES)
+        }
     }
-    req = urllib.request.Request(url, headers=headers, method="HEAD")
-    try:
-        with urllib.request.urlopen(req) as response:
-            return response.getcode() == 200
-    except urllib.error.HTTPError as e:
-        if e.code == 404:
-            return False
-        else:
-            raise e
-
-
-def fetch_all_dandisets():
-    url = "https://api.dandiarchive.org/api/dandisets/?page=1&page_size=5000&ordering=-modified&draft=true&empty=false&embargoed=false"
-    with urllib.request.urlopen(url) as response:
-        X = json.loads(response.read())
-
-    dandisets: List[Dandiset] = []
-    for ds in X["results"]:
-        pv = ds["most_recent_published_version"]
-        dv = ds["draft_version"]
-        dandisets.append(
-            Dandiset(
-                dandiset_id=ds["identifier"],
-                version=pv["version"] if pv else dv["version"],
-            )
-        )
-    return dandisets
-
-
-def _upload_file_to_s3(s3, bucket, object_key, fname):
-    if fname.endswith(".html"):
-        content_type = "text/html"
-    elif fname.endswith(".js"):
-        content_type = "application/javascript"
-    elif fname.endswith(".css"):
-        content_type = "text/css"
-    elif fname.endswith(".png"):
-        content_type = "image/png"
-    elif fname.endswith(".jpg"):
-        content_type = "image/jpeg"
-    elif fname.endswith(".svg"):
-        content_type = "image/svg+xml"
-    elif fname.endswith(".json"):
-        content_type = "application/json"
-    elif fname.endswith(".gz"):
-        content_type = "application/gzip"
-    else:
-        content_type = None
-    extra_args = {}
-    if content_type is not None:
-        extra_args["ContentType"] = content_type
-    num_retries = 3
-    while True:
-        try:
-            s3.upload_file(fname, bucket, object_key, ExtraArgs=extra_args)
-            break
-        except Exception as e:
-            print(f"Error uploading {object_key} to S3: {e}")
-            time.sleep(3)
-            num_retries -= 1
-            if num_retries == 0:
-                raise
-
-
-def _download_json(url: str) -> dict:
-    num_retries = 3
-    while True:
-        try:
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
-            }
-            req = urllib.request.Request(url, headers=headers)
-            with urllib.request.urlopen(req) as response:
-                return json.loads(response.read())
-        except Exception as e:
-            print(f"Error downloading {url}: {e}")
-            time.sleep(3)
-            num_retries -= 1
-            if num_retries == 0:
-                raise
-
-
-class Dandiset(BaseModel):
-    dandiset_id: str
-    version: str
+    return zarr_json_meta
 
 
 if __name__ == '__main__':
@@ -1,14 +1,35 @@
-from typing import List
-import time
-import json
+from typing import List, Set, Union
 import os
+import hashlib
+import threading
 import tempfile
-from pydantic import BaseModel
-import boto3
-import urllib.request
-import urllib.error
-import dandi.dandiarchive as da
+import gzip
+import zstandard
+from dandi.dandiapi import DandiAPIClient
+from dandi.exceptions import NotFoundError
 from concurrent.futures import ThreadPoolExecutor, as_completed
+from _common import (
+    fetch_all_dandisets,
+    _get_s3_client,
+    _map_in_batches,
+    _list_existing_keys,
+    _upload_file_to_s3,
+    _download_json,
+    _json_loads,
+    _json_dumps,
+    _get_neurodata_types_for_zarr_json,
+    LINDI_GENERATION_VERSION,
+)
+
+num_parallel_assets = 16
+
+# per-dandiset results from previous runs (persisted across workflow runs with
+# actions/cache). Each is stored with the key it was computed for (see
+# _results_cache_key) and reused only while that key stays the same.
+_RESULTS_CACHE_DIR = os.environ.get(
+    "NEUROSIFT_RESULTS_CACHE_DIR",
+    os.path.expanduser("~/.cache/neurosift-kerchunker/results")
+) + "/neurodata_types"
 
 
 def main():
@@ -31,124 +52,135 @@ def create_neurodata_types_index():
 
     dandisets = fetch_all_dandisets()
 
-    # get existing neurodata types index
+    # boto3 clients are thread-safe, so build one and share it with every dandiset
     s3 = _get_s3_client()
-    try:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            s3.download_file("neurosift-lindi", "dandi/neurodata_types_index.json.gz", tmpdir + "/neurodata_types_index.json.gz")
-            os.system(f"gunzip {tmpdir}/neurodata_types_index.json.gz")
-            with open(tmpdir + "/neurodata_types_index.json", "r") as f:
-                existing_neurodata_types_index = json.load(f)
-    except Exception as e:
-        print(f"Error downloading existing neurodata types index: {e}")
+
+    # get existing neurodata types index (the .zst has been written alongside the .gz since
+    # it was introduced; fall back to the .gz for indexes written before that)
+    existing_neurodata_types_index = None
+    for key, decompress in [
+        # decompressobj because the streamed frame doesn't record its content size
+        ("dandi/neurodata_types_index.json.zst", lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data)),
+        ("dandi/neurodata_types_index.json.gz", gzip.decompress)
+    ]:
+        try:
+            obj = s3.get_object(Bucket="neurosift-lindi", Key=key)
+            existing_neurodata_types_index = _json_loads(decompress(obj["Body"].read()))
+            break
+        except Exception as e:
+            print(f"Error downloading existing neurodata types index {key}: {e}")
+    if existing_neurodata_types_index is None:
         existing_neurodata_types_index = {"files": []}
 
     existing_neurodata_types_by_asset_id = {}
     for file in existing_neurodata_types_index["files"]:
         existing_neurodata_types_by_asset_id[file["asset_id"]] = file["neurodata_types"]
 
-    all_files = []
-    with ThreadPoolExecutor(max_workers=6) as executor:
-        futures = {
-            executor.submit(
-                handle_dandiset, dandiset.dandiset_id, dandiset.version, existing_neurodata_types_by_asset_id
-            ):
-            dandiset for dandiset in dandisets
-        }
-        num_completed = 0
-        for future in as_completed(futures):
-            num_completed += 1
-            print(f"Completed {num_completed}/{len(dandisets)} dandisets")
-            try:
-                files = future.result()
-                if files:
-                    all_files.extend(files)
-                    print(f'Number of files so far: {len(all_files)}')
-            except Exception as e:
-                print(f"Error processing dandiset: {e}")
-
+    # Stream each dandiset's files into the compressed indexes as it completes
+    # rather than holding every row in memory until the end. The .json.zst is
+    # smaller and faster to decompress; the .json.gz is kept for existing readers.
     with tempfile.TemporaryDirectory() as tmpdir:
-        with open(tmpdir + "/neurodata_types_index.json", "w") as f:
-            json.dump({"files": all_files}, f, indent=2, sort_keys=True)
-        os.system(f"gzip {tmpdir}/neurodata_types_index.json")
-        # determine size of neurodata_types_index.json.gz
-        size = os.path.getsize(f"{tmpdir}/neurodata_types_index.json.gz")
-        print(f"Size of neurodata_types_index.json.gz (MB): {size / 1024 / 1024}")
-        s3 = _get_s3_client()
-        print("Uploading neurodata_types_index.json.gz to S3")
-        _upload_file_to_s3(
-            s3,
-            "neurosift-lindi",
-            "dandi/neurodata_types_index.json.gz",
-            tmpdir + "/neurodata_types_index.json.gz",
-        )
-
-
-def _get_s3_client():
-    return boto3.client(
-        "s3",
-        aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
-        aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
-        endpoint_url=os.environ["S3_ENDPOINT_URL"],
-        region_name="auto",  # for cloudflare
-    )
+        output_fnames = {
+            "dandi/neurodata_types_index.json.gz": tmpdir + "/neurodata_types_index.json.gz",
+            "dandi/neurodata_types_index.json.zst": tmpdir + "/neurodata_types_index.json.zst"
+        }
+        num_files = 0
+        with gzip.open(output_fnames["dandi/neurodata_types_index.json.gz"], "wb") as f_gz, \
+                open(output_fnames["dandi/neurodata_types_index.json.zst"], "wb") as f_zst_raw, \
+                zstandard.ZstdCompressor(level=15, threads=-1).stream_writer(f_zst_raw) as f_zst:
+            def write(data: bytes):
+                f_gz.write(data)
+                f_zst.write(data)
+            write(b'{"files": [')
+            # one client (and its keep-alive session) shared by all dandisets
+            with DandiAPIClient() as client, ThreadPoolExecutor(max_workers=6) as executor:
+                futures = {
+                    executor.submit(
+                        handle_dandiset, client, s3, dandiset.dandiset_id, dandiset.version, existing_neurodata_types_by_asset_id
+                    ):
+                    dandiset for dandiset in dandisets
+                }
+                num_completed = 0
+                for future in as_completed(futures):
+                    num_completed += 1
+                    print(f"Completed {num_completed}/{len(dandisets)} dandisets")
+                    try:
+                        files = future.result()
+                    except Exception as e:
+                        print(f"Error processing dandiset: {e}")
+                        continue
+                    for file in files or []:
+                        if num_files > 0:
+                            write(b",")
+                        write(b"\n" + _json_dumps(file, sort_keys=True))
+                        num_files += 1
+                    if files:
+                        print(f'Number of files so far: {num_files}')
+            write(b"\n]}\n")
+        for key, fname in output_fnames.items():
+            size = os.path.getsize(fname)
+            print(f"Size of {key} (MB): {size / 1024 / 1024}")
+            print(f"Uploading {key} to S3")
+            _upload_file_to_s3(
+                s3,
+                "neurosift-lindi",
+                key,
+                fname,
+            )
 
 
 def handle_dandiset(
+    client: DandiAPIClient,
+    s3,
     dandiset_id: str,
     dandiset_version: str,
     existing_neurodata_types_by_asset_id: dict
 ):
     print(f"Processing dandiset {dandiset_id} version {dandiset_version}")
 
-    # Create the dandi parsed url
-    parsed_url = da.parse_dandi_url(f"https://dandiarchive.org/dandiset/{dandiset_id}")
-
-    with parsed_url.navigate() as (client, dandiset, assets):
-        if dandiset is None:
-            print(f"Dandiset {dandiset_id} not found.")
-            return
-
-        files = []
+    existing_keys = _list_existing_keys(s3, dandiset_id)
 
-        num_consecutive_not_nwb = 0
-        num_consecutive_not_found = 0
-        # important to respect the iterator so we don't pull down all the assets at once
-        # and overwhelm the server
-        num_assets_processed = 0
-        for asset_obj in dandiset.get_assets('path'):
-            if not asset_obj.path.endswith(".nwb"):
-                num_consecutive_not_nwb += 1
-                if num_consecutive_not_nwb >= 20:
-                    # For example, this is important for 000026 because there are so many non-nwb assets
-                    print("Stopping dandiset because too many consecutive non-NWB files.")
-                    break
-                continue
-            else:
-                num_consecutive_not_nwb = 0
+    try:
+        dandiset = client.get_dandiset(dandiset_id, dandiset_version)
+        cache_key = _results_cache_key(dandiset.version, existing_keys)
+    except NotFoundError:
+        print(f"Dandiset {dandiset_id} not found.")
+        return
+
+    fname = f'{_RESULTS_CACHE_DIR}/{dandiset_id}_{dandiset_version}.json'
+    if os.path.exists(fname):
+        with open(fname, 'rb') as f:
+            cached = _json_loads(f.read())
+        if cached.get('key') == cache_key:
+            return cached['files']
+
+    files = []
+
+    num_consecutive_not_found = 0
+    # important to respect the iterator so we don't pull down all the assets at once
+    # and overwhelm the server. The lindi files for each batch of assets are fetched
+    # concurrently (that's a different server).
+    num_assets_processed = 0
+    with ThreadPoolExecutor(max_workers=num_parallel_assets) as asset_executor:
+        for asset_obj, neurodata_types in _map_in_batches(
+            asset_executor,
+            lambda asset_obj: _get_neurodata_types_for_asset(dandiset_id, asset_obj.identifier, existing_keys, existing_neurodata_types_by_asset_id),
+            dandiset.get_assets_by_glob('*.nwb', 'path'),
+            batch_size=num_parallel_assets
+        ):
             if num_consecutive_not_found >= 20:
                 print("Stopping dandiset because too many consecutive missing files.")
                 break
             if num_assets_processed >= 100:
                 print("Stopping dandiset because 100 assets have been processed.")
                 break
+            if neurodata_types is None:
+                num_consecutive_not_found += 1
+                continue
             asset_id = asset_obj.identifier
             asset_path = asset_obj.path
             file_key = f'dandi/dandisets/{dandiset_id}/assets/{asset_id}/nwb.lindi.json'
             zarr_json_url = f'https://lindi.neurosift.org/{file_key}'
-            if not _remote_file_exists(zarr_json_url):
-                num_consecutive_not_found += 1
-                continue
-            if asset_id in existing_neurodata_types_by_asset_id:
-                neurodata_types = existing_neurodata_types_by_asset_id[asset_id]
-            else:
-                zarr_json = _download_json(zarr_json_url)
-                generation_metadata = zarr_json.get("generationMetadata", {})
-                generation_version = generation_metadata.get("generatedByVersion")
-                if generation_version != 9:
-                    num_consecutive_not_found += 1
-                    continue
-                neurodata_types = _get_neurodata_types_for_zarr_json(zarr_json)
             file = {
                 'dandiset_id': dandiset_id,
                 'dandiset_version': dandiset_version,
@@ -159,111 +191,42 @@ def handle_dandiset(
             }
             files.append(file)
             num_assets_processed += 1
-        return files
+    os.makedirs(_RESULTS_CACHE_DIR, exist_ok=True)
+    tmp_fname = f'{fname}.{os.getpid()}.{threading.get_ident()}.tmp'
+    with open(tmp_fname, 'wb') as f:
+        f.write(_json_dumps({'key': cache_key, 'files': files}))
+    os.replace(tmp_fname, fname)
+    return files
 
 
-def _get_neurodata_types_for_zarr_json(zarr_json: dict) -> List[str]:
-    neurodata_types = set()
-    refs = zarr_json.get("refs", {})
-    for key in refs:
-        if key.endswith('.zattrs'):
-            zattrs = refs[key]
-            ndt = zattrs.get("neurodata_type")
-            if ndt:
-                neurodata_types.add(ndt)
-    return sorted(neurodata_types)
+def _results_cache_key(version, existing_keys: Set[str]) -> str:
+    # The results change when the assets of the dandiset change (a draft keeps
+    # the same version name, but its modified time moves) or when lindi files
+    # get generated for more of its assets, which doesn't touch the dandiset.
+    keys_hash = hashlib.sha1('\n'.join(sorted(existing_keys)).encode('utf-8')).hexdigest()
+    return f'v{LINDI_GENERATION_VERSION}:{version.modified.isoformat()}:{version.asset_count}:{keys_hash}'
 
 
-def _remote_file_exists(url: str) -> bool:
-    # use a HEAD request to check if the file exists
-    headers = {  # user-agent is required for some servers
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
-    }
-    req = urllib.request.Request(url, headers=headers, method="HEAD")
-    try:
-        with urllib.request.urlopen(req) as response:
-            return response.getcode() == 200
-    except urllib.error.HTTPError as e:
-        if e.code == 404:
-            return False
-        else:
-            raise e
-
-
-def fetch_all_dandisets():
-    url = "https://api.dandiarchive.org/api/dandisets/?page=1&page_size=5000&ordering=-modified&draft=true&empty=false&embargoed=false"
-    with urllib.request.urlopen(url) as response:
-        X = json.loads(response.read())
-
-    dandisets: List[Dandiset] = []
-    for ds in X["results"]:
-        pv = ds["most_recent_published_version"]
-        dv = ds["draft_version"]
-        dandisets.append(
-            Dandiset(
-                dandiset_id=ds["identifier"],
-                version=pv["version"] if pv else dv["version"],
-            )
-        )
-    return dandisets
-
-
-def _upload_file_to_s3(s3, bucket, object_key, fname):
-    if fname.endswith(".html"):
-        content_type = "text/html"
-    elif fname.endswith(".js"):
-        content_type = "application/javascript"
-    elif fname.endswith(".css"):
-        content_type = "text/css"
-    elif fname.endswith(".png"):
-        content_type = "image/png"
-    elif fname.endswith(".jpg"):
-        content_type = "image/jpeg"
-    elif fname.endswith(".svg"):
-        content_type = "image/svg+xml"
-    elif fname.endswith(".json"):
-        content_type = "application/json"
-    elif fname.endswith(".gz"):
-        content_type = "application/gzip"
-    else:
-        content_type = None
-    extra_args = {}
-    if content_type is not None:
-        extra_args["ContentType"] = content_type
-    num_retries = 3
-    while True:
-        try:
-            s3.upload_file(fname, bucket, object_key, ExtraArgs=extra_args)
-            break
-        except Exception as e:
-            print(f"Error uploading {object_key} to S3: {e}")
-            time.sleep(3)
-            num_retries -= 1
-            if num_retries == 0:
-                raise
-
-
-def _download_json(url: str) -> dict:
-    num_retries = 3
-    while True:
-        try:
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
-            }
-            req = urllib.request.Request(url, headers=headers)
-            with urllib.request.urlopen(req) as response:
-                return json.loads(response.read())
-        except Exception as e:
-            print(f"Error downloading {url}: {e}")
-            time.sleep(3)
-            num_retries -= 1
-            if num_retries == 0:
-                raise
-
-
-class Dandiset(BaseModel):
-    dandiset_id: str
-    version: str
+def _get_neurodata_types_for_asset(
+    dandiset_id: str,
+    asset_id: str,
+    existing_keys: Set[str],
+    existing_neurodata_types_by_asset_id: dict
+) -> Union[List[str], None]:
+    file_key = f'dandi/dandisets/{dandiset_id}/assets/{asset_id}/nwb.lindi.json'
+    zarr_json_url = f'https://lindi.neurosift.org/{file_key}'
+    if file_key not in existing_keys:
+        return None
+    if asset_id in existing_neurodata_types_by_asset_id:
+        return existing_neurodata_types_by_asset_id[asset_id]
+    zarr_json = _download_json(zarr_json_url, lazy=True, generation_version=LINDI_GENERATION_VERSION)
+    if zarr_json is None:
+        return None
+    generation_metadata = zarr_json.get("generationMetadata", {})
+    generation_version = generation_metadata.get("generatedByVersion")
+    if generation_version != LINDI_GENERATION_VERSION:
+        return None
+    return _get_neurodata_types_for_zarr_json(zarr_json)
 
 
 if __name__ == '__main__':
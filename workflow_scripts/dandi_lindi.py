@@ -1,20 +1,67 @@
 import time
-import urllib.request
-import urllib.error
-import filelock
 import json
 import multiprocessing
-from typing import List
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from typing import List, Set, Union
 import os
-import tempfile
-from pydantic import BaseModel
-import boto3
-import dandi.dandiarchive as da
+from dandi.dandiapi import DandiAPIClient
+from dandi.exceptions import NotFoundError
 import lindi
-
-# warning: don't use force=True when running more than one instance of this script because the locking won't do the right thing
+from _common import (
+    LINDI_GENERATION_VERSION,
+    _SESSION,
+    fetch_all_dandisets,
+    _get_s3_client,
+    _map_in_batches,
+    _download_json,
+    _json_dumps,
+    _upload_bytes_to_s3,
+)
+from _console import _console_print, write_console_output
+
+# warning: each asset is queued exactly once per run, but nothing coordinates
+# separate instances of this script, so don't run more than one at a time
 force = False
 
+# the producer checks the existing files of this many assets at a time,
+# concurrently, so that only the assets with something to do are queued
+precheck_batch_size = 64
+num_precheck_threads = 16
+
+# assets handled concurrently within each worker process
+num_threads_per_worker = 4
+
+# once the time budget is used up, how long the workers get to finish the
+# assets they have already started before they are terminated
+worker_shutdown_grace_sec = 60 * 10
+
+# The conversion itself is serialized within a process: write_console_output
+# redirects the process-wide stdout/stderr, and h5py holds a global lock anyways.
+# The uploads of the other threads overlap with it, so everything that runs on
+# the worker threads prints with _console_print, which isn't captured.
+_conversion_lock = threading.Lock()
+
+# When set, the remote reads of the conversions are kept in lindi's sqlite
+# LocalCache there, so that regenerating the same assets (e.g. after a version
+# bump) mostly reads from disk. The cache is never pruned, hence opt-in.
+_LINDI_CACHE_DIR = os.environ.get("NEUROSIFT_LINDI_CACHE_DIR")
+_thread_local = threading.local()
+
+# for testing, only process select dandisets (see dandi_lindi)
+# _ALLOWED_DANDISETS = frozenset({
+#     '000003', '000019', '000021', '000022', '000028', '000034', '000041', '000044',
+#     '000048', '000055', '000056', '000059', '000061', '000065', '000067', '000070',
+#     '000114', '000115', '000149', '000165', '000166', '000213', '000218', '000223',
+#     '000230', '000233', '000248', '000253', '000294', '000299', '000339', '000363',
+#     '000397', '000398', '000399', '000410', '000411', '000447', '000458', '000463',
+#     '000465', '000473', '000481', '000482', '000546', '000552', '000554', '000568',
+#     '000574', '000575', '000576', '000582', '000618', '000623', '000629', '000673',
+#     '000687', '000696', '000710', '000713', '000717', '000732', '000876', '000932',
+#     '000935', '000937', '000957', '000960'
+# })
+
 
 def main():
     dandi_lindi(
@@ -41,322 +88,392 @@ def dandi_lindi(
         raise ValueError("S3_ENDPOINT_URL not set.")
 
     dandisets = fetch_all_dandisets()
+    s3 = _get_s3_client()
 
     num_parallel = 6
 
+    # The assets are iterated once, by handle_dandiset, and handed out to worker
+    # processes that live for the whole run, so that a slow asset at the end of
+    # one dandiset doesn't hold up the start of the next one.
+    task_q = multiprocessing.Queue(maxsize=2 * num_parallel * num_threads_per_worker)
+    # assets that failed in any of the workers
+    num_failed = multiprocessing.Value('i', 0)
+    workers = [
+        multiprocessing.Process(target=_asset_worker, args=(task_q, num_failed))
+        for _ in range(num_parallel)
+    ]
+    for w in workers:
+        w.start()
+
     timer = time.time()
-    for dandiset_index, dandiset in enumerate(dandisets):
-        # for dandiset_id in dandiset_ids:
-        # dandiset = next((x for x in dandisets if x.dandiset_id == dandiset_id), None)
-        # if dandiset is None:
-        #     print(f"Dandiset {dandiset_id} not found.")
-        #     continue
-        print("")
-        print(f"Processing {dandiset.dandiset_id} version {dandiset.version} (dandiset {dandiset_index + 1} / {len(dandisets)})")
-        # if dandiset.dandiset_id not in ['000003', '000019', '000021', '000022', '000028', '000034', '000041', '000044', '000048', '000055', '000056', '000059', '000061', '000065', '000067', '000070', '000114', '000115', '000149', '000165', '000166', '000213', '000218', '000223', '000230', '000233', '000248', '000253', '000294', '000299', '000339', '000363', '000397', '000398', '000399', '000410', '000411', '000447', '000458', '000463', '000465', '000473', '000481', '000482', '000546', '000552', '000554', '000568', '000574', '000575', '000576', '000582', '000618', '000623', '000629', '000673', '000687', '000696', '000710', '000713', '000717', '000732', '000876', '000932', '000935', '000937', '000957', '000960']:
-        #     # for testing, only process select dandisets
-        #     continue
-        with multiprocessing.Pool(num_parallel) as p:
-            async_results = [
-                p.apply_async(handle_dandiset, args=(dandiset.dandiset_id, max_time_sec_per_dandiset, num_parallel, ii))
-                for ii in range(num_parallel)
-            ]
-            for async_result in async_results:
-                async_result.get()
-        elapsed_sec = time.time() - timer
-        print(f"Time elapsed thus far: {elapsed_sec} seconds")
-        if elapsed_sec > max_time_sec:
-            print(f"Time limit reached for dandiset {dandiset.dandiset_id}.")
-            break
+    deadline = timer + max_time_sec
+    try:
+        # one client (and its keep-alive session) shared by all dandisets
+        with DandiAPIClient() as client:
+            for dandiset_index, dandiset in enumerate(dandisets):
+                # for dandiset_id in dandiset_ids:
+                # dandiset = next((x for x in dandisets if x.dandiset_id == dandiset_id), None)
+                # if dandiset is None:
+                #     print(f"Dandiset {dandiset_id} not found.")
+                #     continue
+                print("")
+                print(f"Processing {dandiset.dandiset_id} version {dandiset.version} (dandiset {dandiset_index + 1} / {len(dandisets)})")
+                # if dandiset.dandiset_id not in _ALLOWED_DANDISETS:
+                #     # for testing, only process select dandisets
+                #     continue
+                # one listing per dandiset, shared by the workers, instead of HEAD requests for every asset
+                existing_keys = _list_dandiset_keys(s3, dandiset.dandiset_id)
+                # the assets of a dandiset that haven't been started by then are skipped by the workers
+                dandiset_deadline = min(time.time() + max_time_sec_per_dandiset, deadline)
+                handle_dandiset(client, s3, dandiset.dandiset_id, existing_keys, task_q, workers, dandiset_deadline)
+                elapsed_sec = time.time() - timer
+                print(f"Time elapsed thus far: {elapsed_sec} seconds")
+                if elapsed_sec > max_time_sec:
+                    print(f"Time limit reached for dandiset {dandiset.dandiset_id}.")
+                    break
+    finally:
+        num_crashed = _stop_workers(task_q, workers, max(deadline, time.time()) + worker_shutdown_grace_sec)
+    # a failed asset doesn't stop the run, but a systematic breakage (bad
+    # credentials, a lindi API change) must not look like a successful job
+    if num_failed.value > 0 or num_crashed > 0:
+        raise RuntimeError(f"{num_failed.value} assets failed and {num_crashed} workers crashed")
+
+
+def _put_task(task_q, workers, task, deadline: float) -> bool:
+    # False if the queue was still full at the deadline. A worker that died
+    # natively (a segfault in h5py, the OOM killer) never takes anything off
+    # the queue again, so this doesn't wait on the queue alone.
+    while True:
+        if not any(w.is_alive() for w in workers):
+            raise RuntimeError("All the asset workers have exited")
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        try:
+            task_q.put(task, timeout=min(remaining, 10))
+            return True
+        except queue.Full:
+            pass
+
+
+def _stop_workers(task_q, workers, deadline: float) -> int:
+    # returns the number of workers that crashed; the ones still busy at the
+    # deadline are terminated
+    try:
+        for _ in workers:
+            if not _put_task(task_q, workers, None, deadline):
+                break
+    except RuntimeError:
+        pass  # they have all exited already
+    num_crashed = 0
+    for w in workers:
+        w.join(timeout=max(0, deadline - time.time()))
+        if w.is_alive():
+            print(f"Terminating worker {w.pid}, which is still busy after the time limit")
+            w.terminate()
+            w.join()
+        elif w.exitcode != 0:
+            print(f"Worker {w.pid} exited with code {w.exitcode}")
+            num_crashed += 1
+    # don't let exiting wait on flushing tasks that no worker will read anymore
+    task_q.cancel_join_thread()
+    return num_crashed
 
 
 def handle_dandiset(
+    client: DandiAPIClient,
+    s3,
     dandiset_id: str,
-    max_time_sec: float,
-    modulus: int,
-    modulus_offset: int
+    existing_keys: Union[Set[str], None],
+    task_q,
+    workers,
+    deadline: float
 ):
-    timer = time.time()
-
-    # Create the dandi parsed url
-    parsed_url = da.parse_dandi_url(f"https://dandiarchive.org/dandiset/{dandiset_id}")
-
-    with parsed_url.navigate() as (client, dandiset, assets):
-        if dandiset is None:
-            print(f"Dandiset {dandiset_id} not found.")
-            return
+    try:
+        # the most recent published version, or the draft
+        dandiset = client.get_dandiset(dandiset_id)
+    except NotFoundError:
+        print(f"Dandiset {dandiset_id} not found.")
+        return
 
-        num_consecutive_not_nwb = 0
-        asset_index = 0
-        num_assets_processed = 0
-        # important to respect the iterator so we don't pull down all the assets at once
-        # and overwhelm the server
-        for asset_obj in dandiset.get_assets('path'):
-            if not asset_obj.path.endswith(".nwb"):
-                num_consecutive_not_nwb += 1
-                if num_consecutive_not_nwb >= 20:
-                    # For example, this is important for 000026 because there are so many non-nwb assets
-                    print("Skipping dandiset because too many consecutive non-NWB files.")
-                    return
+    num_queued = 0
+    migrations = []
+    with ThreadPoolExecutor(max_workers=num_precheck_threads) as executor:
+        for (asset_index, asset, asset_existing_keys), action in _map_in_batches(
+            executor,
+            lambda item: _precheck_asset(s3, item[1], item[2]),
+            _iter_nwb_assets(dandiset, dandiset_id, existing_keys, deadline),
+            precheck_batch_size
+        ):
+            if action is None:
                 continue
-            else:
-                num_consecutive_not_nwb = 0
-            if asset_index % modulus != modulus_offset:
-                asset_index += 1
+            if action == "migrate":
+                # just two S3 calls, so these run on the precheck threads rather than a worker
+                migrations.append(executor.submit(_migrate_asset, s3, asset))
                 continue
-            asset = {
-                "identifier": asset_obj.identifier,
-                "path": asset_obj.path,
-                "size": asset_obj.size,
-                "download_url": asset_obj.download_url,
-                "dandiset_id": dandiset_id,
-            }
-            try:
-                process_asset(asset, num=asset_index)
-            except Exception as e:
-                print(asset['download_url'])
-                print(f"Error processing asset {asset_index} ({asset['identifier']}): {e}")
-                raise
-            num_assets_processed += 1
-            elapsed_sec = time.time() - timer
-            if elapsed_sec > max_time_sec:
+            # blocks while the workers are busy, since the queue is bounded
+            if not _put_task(task_q, workers, (asset_index, asset, deadline), deadline):
                 print("Time limit reached.")
+                break
+            num_queued += 1
+    for future in migrations:
+        try:
+            future.result()
+        except Exception as e:
+            print(f"Error moving zarr.json to nwb.lindi.json: {e}")
+    print(f"Queued {num_queued} assets and moved {len(migrations)} zarr.json files in dandiset {dandiset_id}")
+
+
+def _iter_nwb_assets(dandiset, dandiset_id: str, existing_keys: Union[Set[str], None], deadline: float):
+    num_consecutive_not_nwb = 0
+    asset_index = 0
+    # important to respect the iterator so we don't pull down all the assets at once
+    # and overwhelm the server
+    for asset_obj in dandiset.get_assets('path'):
+        if not asset_obj.path.endswith(".nwb"):
+            num_consecutive_not_nwb += 1
+            if num_consecutive_not_nwb >= 20:
+                # For example, this is important for 000026 because there are so many non-nwb assets
+                print("Skipping dandiset because too many consecutive non-NWB files.")
                 return
-            asset_index += 1
-        print(f"Processed {num_assets_processed} assets in dandiset {dandiset_id}")
+            continue
+        else:
+            num_consecutive_not_nwb = 0
+        asset = {
+            "identifier": asset_obj.identifier,
+            "path": asset_obj.path,
+            "size": asset_obj.size,
+            "download_url": asset_obj.download_url,
+            "dandiset_id": dandiset_id,
+        }
+        if existing_keys is not None:
+            # the precheck only needs to know about the files of this asset
+            asset_prefix = f'dandi/dandisets/{dandiset_id}/assets/{asset_obj.identifier}/'
+            asset_existing_keys = {
+                asset_prefix + name for name in ('nwb.lindi.json', 'info.json', 'zarr.json')
+                if asset_prefix + name in existing_keys
+            }
+        else:
+            asset_existing_keys = None
+        yield asset_index, asset, asset_existing_keys
+        asset_index += 1
+        if time.time() > deadline:
+            print("Time limit reached.")
+            return
 
 
-def process_asset(asset, *, num: int):
+def _precheck_asset(s3, asset, existing_keys: Union[Set[str], None]) -> Union[str, None]:
+    # "generate", "migrate" (an old zarr.json to move to nwb.lindi.json), or None
+    # when the asset is up to date or its files couldn't be checked
+    if force:
+        return "generate"
     dandiset_id = asset['dandiset_id']
-    s3 = boto3.client(
-        "s3",
-        aws_access_key_id=os.environ["AWS_ACCESS_KEY_ID"],
-        aws_secret_access_key=os.environ["AWS_SECRET_ACCESS_KEY"],
-        endpoint_url=os.environ["S3_ENDPOINT_URL"],
-        region_name="auto",  # for cloudflare
-    )
     asset_id = asset['identifier']
     file_key = f'dandi/dandisets/{dandiset_id}/assets/{asset_id}/nwb.lindi.json'
     old_zarr_json_file_key = f'dandi/dandisets/{dandiset_id}/assets/{asset_id}/zarr.json'
     info_file_key = f'dandi/dandisets/{dandiset_id}/assets/{asset_id}/info.json'
-    lindi_json_url = f'https://lindi.neurosift.org/{file_key}'
-    old_zarr_json_url = f'https://lindi.neurosift.org/{old_zarr_json_file_key}'
     info_url = f'https://lindi.neurosift.org/{info_file_key}'
-    if not force:
-        try:
-            if _remote_file_exists(lindi_json_url) and _remote_file_exists(info_url):
-                info = _download_json(info_url)
-                generation_metadata = info.get("generationMetadata", {})
-                if generation_metadata.get("generatedBy") == "dandi_lindi":
-                    if generation_metadata.get("generatedByVersion") == 12:
-                        # print(f"Skipping {asset_id} because it already exists.")
-                        return
-            elif _remote_file_exists(old_zarr_json_url):
-                # copying old zarr.json to new nwb.lindi.json
-                print(f"Copying {old_zarr_json_url} to {lindi_json_url}")
-                s3.copy_object(
-                    Bucket="neurosift-lindi",
-                    CopySource={"Bucket": "neurosift-lindi", "Key": old_zarr_json_file_key},
-                    Key=file_key,
-                )
-                # deleting old zarr.json
-                print(f"Deleting {old_zarr_json_url}")
-                s3.delete_object(Bucket="neurosift-lindi", Key=old_zarr_json_file_key)
-                return
-        except:
-            print('Problem checking if remote files exist')
-            return
+    try:
+        if _keys_exist([file_key, info_file_key], existing_keys):
+            generated_by, generated_by_version = _get_generation_info(s3, file_key, info_url)
+            if generated_by == "dandi_lindi":
+                if generated_by_version == LINDI_GENERATION_VERSION:
+                    # print(f"Skipping {asset_id} because it already exists.")
+                    return None
+        elif _keys_exist([old_zarr_json_file_key], existing_keys):
+            return "migrate"
+    except Exception:
+        print('Problem checking if remote files exist')
+        return None
+    return "generate"
+
+
+def _get_generation_info(s3, file_key: str, info_url: str):
+    # nwb.lindi.json and info.json are uploaded with the generation info in their
+    # object metadata, so a HEAD is enough; files uploaded before that need the GET
+    # of info.json itself
+    metadata = s3.head_object(Bucket="neurosift-lindi", Key=file_key).get("Metadata", {})
+    if "generated-by-version" in metadata:
+        return metadata.get("generated-by"), int(metadata["generated-by-version"])
+    generation_metadata = _download_json(info_url).get("generationMetadata", {})
+    return generation_metadata.get("generatedBy"), generation_metadata.get("generatedByVersion")
+
+
+def _asset_worker(task_q, num_failed):
+    # the process-wide client, shared by all the threads
+    s3 = _get_s3_client()
+    with ThreadPoolExecutor(max_workers=num_threads_per_worker) as executor:
+        pending = set()
+        while True:
+            task = task_q.get()
+            if task is None:
+                break
+            asset_index, asset, deadline = task
+            if time.time() > deadline:
+                # the time limit of its dandiset (or of the run) ran out while it was queued
+                continue
+            pending.add(executor.submit(
+                _process_asset_logged, asset, s3=s3, num=asset_index, deadline=deadline, num_failed=num_failed
+            ))
+            if len(pending) >= num_threads_per_worker:
+                # keep the pipeline full rather than waiting for the whole batch
+                _, pending = wait(pending, return_when=FIRST_COMPLETED)
 
-    print(f"Processing asset {asset['download_url']}")
 
-    lock = acquire_lock(asset_id)
-    if lock is None:
-        print(f"Skipping {asset_id} because it is locked.")
-        return
-    try:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            print(f"[{asset['dandiset_id']} {num}] Processing asset {asset_id}: {asset['path']}")
-            timer0 = time.time()
-            with write_console_output(tmpdir + "/output.txt"):
-                _create_lindi_json(asset['download_url'], tmpdir + "/nwb.lindi.json")
-            with open(tmpdir + "/output.txt", "r") as f:
-                output = f.read()
-                print(output)
-            elapsed0 = time.time() - timer0
-            generation_metadata = {
-                "generatedBy": "dandi_lindi",
-                "generatedByVersion": 12,
-                "dandisetId": dandiset_id,
-                "assetId": asset_id,
-                "assetPath": asset['path'],
-                "assetDownloadUrl": asset['download_url'],
-                "assetSize": asset['size'],
-                "generationTimestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
-                "generationDuration": f"{elapsed0:.1f} seconds",
-                "console_output": open(tmpdir + "/output.txt", "r").read()
-            }
-            with open(tmpdir + '/nwb.lindi.json', 'r') as f:
-                lindi_json = json.load(f)
-                lindi_json['generationMetadata'] = generation_metadata
-            info = {
-                'generationMetadata': lindi_json['generationMetadata'],
-            }
-            with open(tmpdir + '/nwb.lindi.json', 'w') as f:
-                json.dump(lindi_json, f, indent=2, sort_keys=True)
-            with open(tmpdir + '/info.json', 'w') as f:
-                json.dump(info, f, indent=2)
-
-            print(f"Uploading {file_key} to S3")
-            _upload_file_to_s3(
-                s3,
-                "neurosift-lindi",
-                file_key,
-                tmpdir + "/nwb.lindi.json"
-            )
-            print(f"Uploading {info_file_key} to S3")
-            _upload_file_to_s3(
-                s3,
-                "neurosift-lindi",
-                info_file_key,
-                tmpdir + "/info.json"
-            )
-            print(f"Time elapsed for asset {asset_id} ({num}): {elapsed0} seconds")
-            print('')
-            print('')
-    finally:
-        release_lock(lock)
+def _migrate_asset(s3, asset):
+    # S3 has no rename: copy the old zarr.json to nwb.lindi.json, then delete it
+    dandiset_id = asset['dandiset_id']
+    asset_id = asset['identifier']
+    file_key = f'dandi/dandisets/{dandiset_id}/assets/{asset_id}/nwb.lindi.json'
+    old_zarr_json_file_key = f'dandi/dandisets/{dandiset_id}/assets/{asset_id}/zarr.json'
+    print(f"Moving {old_zarr_json_file_key} to {file_key}")
+    s3.copy_object(
+        Bucket="neurosift-lindi",
+        CopySource={"Bucket": "neurosift-lindi", "Key": old_zarr_json_file_key},
+        Key=file_key,
+    )
+    s3.delete_object(Bucket="neurosift-lindi", Key=old_zarr_json_file_key)
 
 
-def acquire_lock(asset_id):
-    lock = filelock.FileLock(f'/tmp/dandi_lindi_{asset_id}.lock')
+def _process_asset_logged(asset, *, s3, num: int, deadline: float, num_failed):
+    # one failed asset shouldn't take down the rest of the dandiset; it is
+    # counted, and the run fails at the end
     try:
-        lock.acquire(timeout=1)
-    except filelock.Timeout:
-        return None
-    return lock
+        process_asset(asset, s3=s3, num=num, deadline=deadline)
+    except Exception as e:
+        with num_failed.get_lock():
+            num_failed.value += 1
+        _console_print(asset['download_url'])
+        _console_print(f"Error processing asset {num} ({asset['identifier']}): {e}")
 
 
-def release_lock(lock):
-    lock.release()
+def process_asset(asset, *, s3, num: int, deadline: float):
+    dandiset_id = asset['dandiset_id']
+    asset_id = asset['identifier']
+    file_key = f'dandi/dandisets/{dandiset_id}/assets/{asset_id}/nwb.lindi.json'
+    info_file_key = f'dandi/dandisets/{dandiset_id}/assets/{asset_id}/info.json'
+    _console_print(f"Processing asset {asset['download_url']}")
+
+    _console_print(f"[{asset['dandiset_id']} {num}] Processing asset {asset_id}: {asset['path']}")
+    # nothing touches the disk: the console output is captured in memory and
+    # the generated files are uploaded straight from memory
+    with _conversion_lock:
+        # the other conversions of this worker may have taken a while
+        if time.time() > deadline:
+            _console_print(f"Skipping asset {asset_id} ({num}) because the time limit was reached")
+            return
+        timer0 = time.time()
+        # captured at the file descriptor level, so that output from the HDF5
+        # C library is included too
+        with write_console_output() as captured:
+            rfs = _create_lindi_json(asset['download_url'])
+        console_output = captured.output
+        _console_print(console_output)
+        elapsed0 = time.time() - timer0
+    generation_metadata = {
+        "generatedBy": "dandi_lindi",
+        "generatedByVersion": LINDI_GENERATION_VERSION,
+        "dandisetId": dandiset_id,
+        "assetId": asset_id,
+        "assetPath": asset['path'],
+        "assetDownloadUrl": asset['download_url'],
+        "assetSize": asset['size'],
+        "generationTimestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "generationDuration": f"{elapsed0:.1f} seconds",
+        "console_output": console_output
+    }
+    # the metadata is attached in memory, so the refs are serialized only once
+    rfs['generationMetadata'] = generation_metadata
+    info = {
+        'generationMetadata': generation_metadata,
+    }
+    lindi_json_data = _dumps_lindi_json(rfs)
+    info_data = json.dumps(info, indent=2).encode('utf-8')
+    # info.json is kept as a separate file since neurosift reads it, but the
+    # precheck only needs this
+    object_metadata = {
+        "generated-by": "dandi_lindi",
+        "generated-by-version": str(LINDI_GENERATION_VERSION),
+        "generated-at": generation_metadata["generationTimestamp"]
+    }
+
+    _console_print(f"Uploading {file_key} to S3")
+    _upload_bytes_to_s3(
+        s3,
+        "neurosift-lindi",
+        file_key,
+        lindi_json_data,
+        content_type="application/json",
+        metadata=object_metadata
+    )
+    _console_print(f"Uploading {info_file_key} to S3")
+    _upload_bytes_to_s3(
+        s3,
+        "neurosift-lindi",
+        info_file_key,
+        info_data,
+        content_type="application/json",
+        metadata=object_metadata
+    )
+    _console_print(f"Time elapsed for asset {asset_id} ({num}): {elapsed0} seconds")
+    _console_print('')
+    _console_print('')
 
 
 def _remote_file_exists(url: str) -> bool:
-    # use a HEAD request to check if the file exists
-    headers = {  # user-agent is required for some servers
-        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
-    }
-    req = urllib.request.Request(url, headers=headers, method="HEAD")
+    # use a HEAD request to check if the file exists, following redirects as urllib
+    # did, so that a 3xx isn't reported as missing
+    # (on the shared keep-alive session, so repeated checks skip the TLS handshake)
+    r = _SESSION.head(url, timeout=30, allow_redirects=True)
+    if r.status_code == 404:
+        return False
+    r.raise_for_status()
+    return r.status_code == 200
+
+
+def _list_dandiset_keys(s3, dandiset_id: str) -> Union[Set[str], None]:
+    # a single paginated listing (1000 keys per page) rather than a HEAD request per file
     try:
-        with urllib.request.urlopen(req) as response:
-            return response.getcode() == 200
-    except urllib.error.HTTPError as e:
-        if e.code == 404:
-            return False
-        else:
-            raise e
-
-
-def _create_lindi_json(nwb_url: str, lindi_json_path: str):
-    store = lindi.LindiH5ZarrStore.from_file(nwb_url, opts=lindi.LindiH5ZarrStoreOpts(num_dataset_chunks_threshold=5000))
-    rfs = store.to_reference_file_system()
-    with open(lindi_json_path, 'w') as g:
-        json.dump(rfs, g, indent=2, sort_keys=True)
-
-
-def fetch_all_dandisets():
-    url = "https://api.dandiarchive.org/api/dandisets/?page=1&page_size=5000&ordering=-modified&draft=true&empty=false&embargoed=false"
-    with urllib.request.urlopen(url) as response:
-        X = json.loads(response.read())
-
-    dandisets: List[Dandiset] = []
-    for ds in X["results"]:
-        pv = ds["most_recent_published_version"]
-        dv = ds["draft_version"]
-        dandisets.append(
-            Dandiset(
-                dandiset_id=ds["identifier"],
-                version=pv["version"] if pv else dv["version"],
-            )
-        )
-
-    return dandisets
-
-
-def _upload_file_to_s3(s3, bucket, object_key, fname):
-    if fname.endswith(".html"):
-        content_type = "text/html"
-    elif fname.endswith(".js"):
-        content_type = "application/javascript"
-    elif fname.endswith(".css"):
-        content_type = "text/css"
-    elif fname.endswith(".png"):
-        content_type = "image/png"
-    elif fname.endswith(".jpg"):
-        content_type = "image/jpeg"
-    elif fname.endswith(".svg"):
-        content_type = "image/svg+xml"
-    elif fname.endswith(".json"):
-        content_type = "application/json"
-    elif fname.endswith(".gz"):
-        content_type = "application/gzip"
-    else:
-        content_type = None
-    extra_args = {}
-    if content_type is not None:
-        extra_args["ContentType"] = content_type
-    num_retries = 3
-    while True:
-        try:
-            s3.upload_file(fname, bucket, object_key, ExtraArgs=extra_args)
-            break
-        except Exception as e:
-            print(f"Error uploading {object_key} to S3: {e}")
-            time.sleep(3)
-            num_retries -= 1
-            if num_retries == 0:
-                raise
+        paginator = s3.get_paginator('list_objects_v2')
+        return {
+            obj['Key']
+            for page in paginator.paginate(Bucket='neurosift-lindi', Prefix=f'dandi/dandisets/{dandiset_id}/assets/')
+            for obj in page.get('Contents', [])
+        }
+    except Exception as e:
+        print(f"Error listing the existing files for dandiset {dandiset_id}: {e}")
+        return None
 
 
-def _download_json(url: str) -> dict:
-    num_retries = 3
-    while True:
-        try:
-            headers = {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/58.0.3029.110 Safari/537.3"
-            }
-            req = urllib.request.Request(url, headers=headers)
-            with urllib.request.urlopen(req) as response:
-                return json.loads(response.read())
-        except Exception as e:
-            print(f"Error downloading {url}: {e}")
-            time.sleep(3)
-            num_retries -= 1
-            if num_retries == 0:
-                raise
-
-
-class Dandiset(BaseModel):
-    dandiset_id: str
-    version: str
-
-
-class write_console_output:
-    def __init__(self, path):
-        self.path = path
-
-    def __enter__(self):
-        self.f = open(self.path, "w")
-        self.stdout = os.dup(1)
-        self.stderr = os.dup(2)
-        os.dup2(self.f.fileno(), 1)
-        os.dup2(self.f.fileno(), 2)
-
-    def __exit__(self, type, value, traceback):
-        os.dup2(self.stdout, 1)
-        os.dup2(self.stderr, 2)
-        os.close(self.stdout)
-        os.close(self.stderr)
-        self.f.close()
+def _keys_exist(keys: List[str], existing_keys: Union[Set[str], None]) -> bool:
+    if existing_keys is not None:
+        return all(key in existing_keys for key in keys)
+    # the dandiset listing failed: fall back to HEAD requests, issued concurrently
+    urls = [f'https://lindi.neurosift.org/{key}' for key in keys]
+    with ThreadPoolExecutor(max_workers=len(urls)) as executor:
+        return all(list(executor.map(_remote_file_exists, urls)))
+
+
+def _get_local_cache() -> Union[lindi.LocalCache, None]:
+    if _LINDI_CACHE_DIR is None:
+        return None
+    # one per thread, since a sqlite connection can't be used from other threads
+    local_cache = getattr(_thread_local, "local_cache", None)
+    if local_cache is None:
+        local_cache = lindi.LocalCache(cache_dir=_LINDI_CACHE_DIR)
+        _thread_local.local_cache = local_cache
+    return local_cache
+
+
+def _create_lindi_json(nwb_url: str) -> dict:
+    store = lindi.LindiH5ZarrStore.from_file(nwb_url, local_cache=_get_local_cache(), opts=lindi.LindiH5ZarrStoreOpts(num_dataset_chunks_threshold=5000))
+    return store.to_reference_file_system()
+
+
+def _dumps_lindi_json(rfs: dict) -> bytes:
+    # Compact, since indentation makes the files a third bigger for every upload
+    # and download. The keys stay sorted so that generationMetadata comes first.
+    return _json_dumps(rfs, sort_keys=True)
 
 
 if __name__ == '__main__':